@@ -1,18 +1,60 @@
+import os
+import pathlib
 import shutil
+import threading
+import uuid
 
 from git_wrapper.repo import GitRepo
 import pytest
 
 
 UPSTREAM_REPO_ROOT = "/repos/upstream_repo"  # Upstream equivalent
-PATCHES_REPO_ROOT = "/repos/patches_repo"  # Behind upstream + extra commits
-LOCAL_REPO_ROOT = "/repos/local_repo"  # Same as patches repo, used for rebase
+# The repos below are recreated for every test, keep them in memory if we can
+SCRATCH_ROOT = "/dev/shm/repos" if os.path.isdir("/dev/shm") else "/repos"
+TEMPLATE_REPO_ROOT = os.path.join(SCRATCH_ROOT, "_template_patches_repo")
+# Behind upstream + extra commits
+PATCHES_REPO_ROOT = os.path.join(SCRATCH_ROOT, "patches_repo")
+# Same as patches repo, used for rebase
+LOCAL_REPO_ROOT = os.path.join(SCRATCH_ROOT, "local_repo")
+
+DATA_DIR = pathlib.Path(__file__).parent / "test_patch_rebaser"
+
+# Background deletions still in progress
+_CLEANUP_THREADS = []
+
+
+def remove_in_background(path):
+    """Move a directory out of the way and delete it in a thread"""
+    if not os.path.exists(path):
+        return
+    # Renaming within the same filesystem is instant, and frees up the
+    # path for the next test right away
+    trash = os.path.join(SCRATCH_ROOT, f"trash-{uuid.uuid4()}")
+    os.rename(path, trash)
+
+    thread = threading.Thread(target=shutil.rmtree, args=(trash, True),
+                              daemon=True)
+    thread.start()
+    _CLEANUP_THREADS.append(thread)
+
+
+@pytest.fixture(scope="session")
+def template_patches_repo():
+    """A pristine patches repo, set up once and copied for each test"""
+    set_up_patches_repo(DATA_DIR, TEMPLATE_REPO_ROOT)
+
+    yield TEMPLATE_REPO_ROOT
+
+    shutil.rmtree(TEMPLATE_REPO_ROOT, ignore_errors=True)
+    for thread in _CLEANUP_THREADS:
+        thread.join()
 
 
 @pytest.fixture(scope="function")
-def local_repo(datadir):
+def local_repo(template_patches_repo):
     """A clone of the patches repo, with a remote to the 'upstream' repo"""
-    set_up_patches_repo(datadir)
+    # Local clones hardlink the objects, so this is cheap
+    GitRepo.clone(template_patches_repo, PATCHES_REPO_ROOT, bare=True)
 
     local_repo = GitRepo.clone(PATCHES_REPO_ROOT, LOCAL_REPO_ROOT)
     local_repo.remote.add("upstream", UPSTREAM_REPO_ROOT)
@@ -20,8 +62,8 @@ def local_repo(datadir):
     yield local_repo
 
     # Clean up before the next run
-    shutil.rmtree(LOCAL_REPO_ROOT, ignore_errors=True)
-    shutil.rmtree(PATCHES_REPO_ROOT, ignore_errors=True)
+    remove_in_background(LOCAL_REPO_ROOT)
+    remove_in_background(PATCHES_REPO_ROOT)
 
 
 @pytest.fixture(scope="function")
@@ -29,7 +71,7 @@ def patches_repo_root():
     yield PATCHES_REPO_ROOT
 
 
-def set_up_patches_repo(datadir):
+def set_up_patches_repo(datadir, patches_repo_root):
     """Set up an older copy of the upstream repo, and add an extra commit"""
     tmp_repo = "/tmp/patches_repo"
 
@@ -49,6 +91,6 @@ def set_up_patches_repo(datadir):
     tmp_patches_repo.branch.apply_patch("master", patch_path)
 
     # Finally, now that the repo preparations are done, get a bare clone ready
-    GitRepo.clone(tmp_repo, PATCHES_REPO_ROOT, bare=True)
+    GitRepo.clone(tmp_repo, patches_repo_root, bare=True)
 
     shutil.rmtree(tmp_repo, ignore_errors=True)
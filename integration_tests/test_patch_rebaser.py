@@ -1,6 +1,6 @@
-from mock import patch
 import os
 import time
+from unittest.mock import patch
 
 from git_wrapper import exceptions as gw_exceptions
 from git_wrapper.repo import GitRepo
@@ -2,44 +2,206 @@
 # -*- coding: utf-8 -*-
 """Main module."""
 
-try:
-    import configparser
-except ImportError:  # Python 2
-    import ConfigParser as configparser
-from collections import namedtuple
+import configparser
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+import fcntl
+from functools import lru_cache, partial
+import hashlib
 import logging
 import os
+import random
+import sys
+import tempfile
+import threading
 import time
+from urllib.parse import urlsplit
 
-from distroinfo import info, query
-from git_wrapper import exceptions as git_exceptions
-from git_wrapper.repo import GitRepo
+# distroinfo, git and git_wrapper are slow to import, so they are only
+# imported where needed. Skipped packages then never pay for them.
 
 LOGGER = logging.getLogger("patch_rebaser")
 
+# The config file lives next to the currently running script
+CONFIG_FILE = os.path.realpath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                 "patch_rebaser.ini")
+)
+
+# Fetches younger than this many seconds are considered up to date
+FETCH_MAX_AGE = 60
+
+# Where to keep the lock files serializing rebases across processes
+LOCK_DIR = "/var/lock"
+
+# Remote distroinfo older than this many seconds is fetched again
+DISTRO_INFO_TTL = 300
+
+# Loaded distroinfo, as (load time, info) keyed on the distroinfo repo path
+_DISTRO_INFO_CACHE = {}
+
+# Parsed config files, keyed on path, modification time, size and defaults
+_CONFIG_CACHE = {}
+
+# Serialize operations writing to the same repository, keyed on its real
+# path. Locks are reentrant so a package being processed can take its
+# repo's lock again to push.
+_REPO_LOCKS = defaultdict(threading.RLock)
+
+# Push errors meaning the remote branch moved since we last fetched it
+REMOTE_CHANGED_ERRORS = ('stale info', 'non-fast-forward', 'fetch first')
+
+
+class RemoteChangedException(Exception):
+    """The remote branch moved since it was last fetched"""
+
+
+def _parallel_git(*callables):
+    """Run independent read-only git queries concurrently.
+
+    The work is bound by git subprocesses, so threads are enough to
+    overlap them. Returns a tuple with the result of each callable, in
+    the same order.
+    """
+    with ThreadPoolExecutor(max_workers=len(callables)) as executor:
+        futures = [executor.submit(func) for func in callables]
+        return tuple(future.result() for future in futures)
+
+
+@contextmanager
+def locked(name, lock_dir=None):
+    """Hold an exclusive lock on name, shared by all processes on the host.
+
+    Falls back to the temporary directory if lock_dir (LOCK_DIR if not
+    given) is not writable.
+    """
+    lock_dir = lock_dir or LOCK_DIR
+    if not os.access(lock_dir, os.W_OK):
+        lock_dir = tempfile.gettempdir()
+    digest = hashlib.sha1(name.encode("utf-8")).hexdigest()
+    lock_file = os.path.join(lock_dir, f"patch_rebaser-{digest}.lock")
+    # Lock files may be shared between users, so they are made world
+    # readable and opened read-only, which is enough for flock. In a
+    # sticky directory, O_CREAT is refused on another user's file.
+    try:
+        fd = os.open(lock_file, os.O_RDONLY | os.O_CREAT, 0o666)
+    except PermissionError:
+        fd = os.open(lock_file, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def _repo_lock(path):
+    """Return the lock guarding writes to the repository at path"""
+    return _REPO_LOCKS[os.path.realpath(path)]
+
+
+def _remote_url(repo, remote):
+    """Return the url of remote, the first one if it has several"""
+    url = repo.repo.remote(remote).url
+    if isinstance(url, list):
+        url = url[0]
+    return url
+
+
+def fetched_recently(repo, remote, max_age=FETCH_MAX_AGE):
+    """Whether remote was the last one fetched, less than max_age seconds ago
+
+    Git writes FETCH_HEAD on every fetch, including the url it fetched
+    from, so its contents and modification time tell us when that
+    remote was last fetched.
+    """
+    fetch_head = os.path.join(repo.repo.git_dir, 'FETCH_HEAD')
+    try:
+        if time.time() - os.stat(fetch_head).st_mtime >= max_age:
+            return False
+        with open(fetch_head) as fp:
+            lines = fp.read().splitlines()
+    except FileNotFoundError:
+        return False
+
+    url = _remote_url(repo, remote)
+    # FETCH_HEAD lines end with " of <url>", the url being written
+    # without credentials or a trailing .git
+    url = _anonymize_url(url).rstrip('/')
+    if url.endswith('.git'):
+        url = url[:-len('.git')]
+    return any(line.endswith(" of " + url) for line in lines)
+
+
+def _anonymize_url(url):
+    """Strip the user info from a remote url, like git does"""
+    scheme, sep, rest = url.partition('://')
+    if not sep:
+        scheme, rest = '', url
+    host, slash, path = rest.partition('/')
+    # Local paths have no host part to strip
+    if sep or ':' in host:
+        host = host.rpartition('@')[2]
+    return f"{scheme}{sep}{host}{slash}{path}"
+
+
+def fetch_if_stale(repo, remote, max_age=FETCH_MAX_AGE):
+    """Fetch remote, unless it was fetched less than max_age seconds ago.
+
+    Returns whether a fetch was done.
+    """
+    if fetched_recently(repo, remote, max_age):
+        LOGGER.debug("Remote %s was fetched recently, not fetching", remote)
+        return False
+    repo.remote.fetch(remote)
+    return True
+
+
+def list_remote_branches(repo, remote):
+    """Return the names of the branches known for remote, in one git call"""
+    prefix = f"refs/remotes/{remote}/"
+    refs = repo.git.for_each_ref("--format=%(refname)", prefix)
+    return frozenset(ref[len(prefix):] for ref in refs.splitlines())
+
+
+def _remote_heads(repo, remote):
+    """Return the names of the branches on remote, without fetching it"""
+    heads = repo.git.ls_remote("--heads", remote)
+    return frozenset(line.split('\trefs/heads/', 1)[1]
+                     for line in heads.splitlines() if '\t' in line)
+
+
+def _patches_branch_candidates(distgit_branch):
+    """Return possible patches branch names, most specific first"""
+    suffix = '-trunk-patches' if 'trunk' in distgit_branch else '-patches'
+    parts = distgit_branch.split('-')
+    return ['-'.join(parts[:i]) + suffix for i in range(len(parts), 0, -1)]
+
 
 def find_patches_branch(repo, remote, distgit_branch):
     """Guess patches branch name"""
     # Adapted from rdopkg guess.find_patches_branch
-    parts = distgit_branch.split('-')
-    while parts:
-        if 'trunk' in distgit_branch:
-            branch = '%s-trunk-patches' % '-'.join(parts)
-        else:
-            branch = '%s-patches' % '-'.join(parts)
+    branches = list_remote_branches(repo, remote)
+    if not branches:
+        # This remote was not fetched yet, so it has no remote tracking
+        # refs: ask the remote for its branches instead
+        branches = _remote_heads(repo, remote)
+    for branch in _patches_branch_candidates(distgit_branch):
         LOGGER.debug("Checking if branch %s exists...", branch)
-        if repo.branch.exists(branch, remote):
+        if branch in branches:
             return branch
-        parts.pop()
     return None
 
 
-def create_patches_branch(repo, commit, remote, dev_mode=True):
+def create_patches_branch(repo, commit, remote, dev_mode=True,
+                          branch_name=None):
     """Create new patches branch from commit"""
-    branch_name = os.environ.get('PATCHES_BRANCH', None)
     if not branch_name:
-        LOGGER.error("No PATCHES_BRANCH env var found, cannot create branch")
+        LOGGER.error("No PATCHES_BRANCH set for package, cannot create branch")
         return None
 
     if not repo.branch.create(branch_name, commit):
@@ -57,28 +219,29 @@ def create_patches_branch(repo, commit, remote, dev_mode=True):
         repo.git.push("-n", remote, branch_name)
     else:
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        LOGGER.warning(
-            "Pushing {branch} to {remote} ({timestamp})".format(
-                branch=branch_name,
-                remote=remote,
-                timestamp=timestamp
-            )
-        )
+        LOGGER.warning(f"Pushing {branch_name} to {remote} ({timestamp})")
         repo.git.push(remote, branch_name)
 
     return branch_name
 
 
+def get_dlrn_projects(dlrn_projects_ini):
+    """Return the parsed DLRN projects.ini, cached until it changes"""
+    return _parse_config_file(dlrn_projects_ini)
+
+
 def get_downstream_distgit_branch(dlrn_projects_ini):
     """Get downstream distgit branch info from DLRN projects.ini"""
-    config = configparser.ConfigParser()
-    config.read(dlrn_projects_ini)
-    return config.get('downstream_driver', 'downstream_distro_branch')
+    return get_dlrn_projects(dlrn_projects_ini).get(
+        'downstream_driver', 'downstream_distro_branch')
 
 
-def get_patches_branch(repo, remote, dlrn_projects_ini):
-    """Get the patches branch name"""
-    branch_name = os.environ.get('PATCHES_BRANCH', None)
+def get_patches_branch(repo, remote, dlrn_projects_ini, branch_name=None):
+    """Get the patches branch name
+
+    If branch_name is not given, it is guessed from the downstream
+    distgit branch.
+    """
     if branch_name:
         LOGGER.debug("Checking if branch %s exists...", branch_name)
         if repo.branch.exists(branch_name, remote):
@@ -88,67 +251,84 @@ def get_patches_branch(repo, remote, dlrn_projects_ini):
     else:
         # Get downstream distgit branch from DLRN config
         distgit_branch = get_downstream_distgit_branch(dlrn_projects_ini)
-        LOGGER.warning("No PATCHES_BRANCH env var found, trying to guess it")
+        LOGGER.warning("No PATCHES_BRANCH set for package, trying to guess it")
         # Guess at patches branch based on the distgit branch name
         return find_patches_branch(repo, remote, distgit_branch)
 
 
+@lru_cache(maxsize=256)
 def get_release_from_branch_name(branch_name):
-    try:
-        release = branch_name.split('-')[1]
-        # So branch names like rhos-13.0-octavia-trunk-patches will return
-        # 13.0-octavia
-        post_release = branch_name.split('-')[2]
-        if post_release != 'trunk' and post_release != 'patches':
-            return '%s-%s' % (release, post_release)
-        else:
-            return release
-    except IndexError:
+    release, sep, rest = branch_name.partition('-')[2].partition('-')
+    if not sep:
         return 'Unknown'
+    # So branch names like rhos-13.0-octavia-trunk-patches will return
+    # 13.0-octavia
+    post_release = rest.partition('-')[0]
+    if post_release != 'trunk' and post_release != 'patches':
+        return '%s-%s' % (release, post_release)
+    else:
+        return release
 
 
 def parse_distro_info_path(path):
     """Break distro_info path into repo + file"""
-    path = path.strip().rsplit("/", 1)
-    info_repo = path[0]
-    info_file = path[1]
-    remote = False
-
-    if info_repo.startswith("http"):
-        remote = True
+    info_repo, _, info_file = path.strip().rpartition("/")
+    remote = info_repo.startswith("http")
 
     return info_file, info_repo, remote
 
 
+@lru_cache(maxsize=256)
 def parse_gerrit_remote_url(url):
     """Break Gerrit remote url into host, port and project"""
     # We are expecting a remote URL in the format
     # protocol://host:port/project
-    split_url = url.split('/')
-    project = '/'.join(split_url[3:])   # The project part can contain slashes
-    host_port = split_url[2].split(':')
-    host = host_port[0]
-    if len(host_port) > 1:
-        port = host_port[1]
-    else:
-        port = '29418'        # Default Gerrit port
+    parts = urlsplit(url)
+    # Keep any user@ prefix in the host, but not the port
+    host = parts.netloc
+    if parts.port:
+        host = host[:host.rindex(':')]
+    port = str(parts.port or 29418)     # Default Gerrit port
+    project = parts.path.lstrip('/')    # The project can contain slashes
     return host, port, project
 
 
 def get_distro_info(distroinfo_repo):
-    """Set up distro_info based on path"""
+    """Set up distro_info based on path
+
+    Results are cached per distroinfo_repo, so the distroinfo repo is
+    only read and parsed once per process. Info from a remote distroinfo
+    repo is fetched again once it is older than DISTRO_INFO_TTL seconds.
+    """
+    from distroinfo import info
+
     info_file, info_repo, remote = parse_distro_info_path(distroinfo_repo)
 
+    cached = _DISTRO_INFO_CACHE.get(distroinfo_repo)
+    if cached is not None:
+        loaded_at, distro_info = cached
+        if not remote or time.monotonic() - loaded_at < DISTRO_INFO_TTL:
+            return distro_info
+
     if remote:
         di = info.DistroInfo(info_file, remote_git_info=info_repo)
     else:
         di = info.DistroInfo(info_file, local_info=info_repo)
 
-    return di.get_info()
+    distro_info = di.get_info()
+    _DISTRO_INFO_CACHE[distroinfo_repo] = (time.monotonic(), distro_info)
+    return distro_info
+
+
+def clear_distro_info_cache():
+    """Forget all distro_info previously loaded by get_distro_info"""
+    _DISTRO_INFO_CACHE.clear()
 
 
 def get_patches_repo(distroinfo_repo, pkg_name, key):
     """Get URL of repo with the patches branch"""
+    from distroinfo import query
+
     distro_info = get_distro_info(distroinfo_repo)
     pkg = query.get_package(distro_info, pkg_name)
     repo = pkg.get(key)
@@ -157,25 +337,31 @@ def get_patches_repo(distroinfo_repo, pkg_name, key):
     return repo
 
 
-def get_rebaser_configparser(defaults=None):
-    """Return a configparser object for patch_rebaser config"""
-    # Get the config file location based on path of currently running script
-    config_file = os.path.realpath(
-        "{0}/{1}".format(
-            os.path.dirname(os.path.realpath(__file__)),
-            "patch_rebaser.ini"
-        )
-    )
-    if not os.path.exists(config_file):
-        raise Exception(
-            "Configuration file {0} not found.".format(config_file)
-        )
+def _parse_config_file(path, defaults=None):
+    """Return a configparser object for the given file.
 
-    parser = configparser.ConfigParser(defaults)
-    parser.read(config_file)
+    The parsed file is cached until it is modified, so the returned
+    object is shared and must not be modified by callers.
+    """
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size,
+           frozenset((defaults or {}).items()))
+    parser = _CONFIG_CACHE.get(key)
+    if parser is None:
+        parser = configparser.ConfigParser(defaults)
+        parser.read(path)
+        _CONFIG_CACHE[key] = parser
     return parser
 
 
+def get_rebaser_configparser(defaults=None):
+    """Return a configparser object for patch_rebaser config"""
+    try:
+        return _parse_config_file(CONFIG_FILE, defaults)
+    except FileNotFoundError:
+        raise Exception(f"Configuration file {CONFIG_FILE} not found.")
+
+
 def get_rebaser_config(defaults=None):
     """Return a tuple with the configuration information.
 
@@ -183,12 +369,16 @@ def get_rebaser_config(defaults=None):
     defaults dictionary is used. If the defaults doesn't contain the
     value either, a configparser.NoOptionError exception is raised.
 
+    packages_to_process is returned as a frozenset of package names,
+    empty if all packages should be processed.
+
        :param dict defaults: Default values for config values
 
     """
     default_options = ['dev_mode', 'remote_name', 'git_name', 'git_email',
                        'packages_to_process', 'dlrn_projects_ini',
-                       'create_patches_branch']
+                       'create_patches_branch', 'partial_fetch',
+                       'lock_dir']
     distroinfo_options = ['patches_repo_key']
 
     RebaserConfig = namedtuple('RebaserConfig',
@@ -196,21 +386,34 @@ def get_rebaser_config(defaults=None):
 
     parser = get_rebaser_configparser(defaults)
 
+    # Read the whole DEFAULT section (including the defaults passed in)
+    # once, rather than resolving each option through the parser
+    defaults_section = dict(parser['DEFAULT'])
+
     options = {}
     for opt in default_options:
-        if opt == 'dev_mode' or opt == 'create_patches_branch':
-            options[opt] = parser.getboolean('DEFAULT', opt)
+        try:
+            value = defaults_section[opt]
+        except KeyError:
+            raise configparser.NoOptionError(opt, 'DEFAULT')
+
+        if opt in ('dev_mode', 'create_patches_branch', 'partial_fetch'):
+            try:
+                options[opt] = parser.BOOLEAN_STATES[value.lower()]
+            except KeyError:
+                raise ValueError('Not a boolean: %s' % value)
         elif opt == 'packages_to_process':
-            pkgs = parser.get('DEFAULT', opt)
-            if pkgs:
-                pkgs = pkgs.split(",") if "," in pkgs else [pkgs]
-            options[opt] = pkgs
+            options[opt] = frozenset(
+                pkg.strip() for pkg in value.split(",") if pkg.strip()
+            )
         else:
-            options[opt] = parser.get('DEFAULT', opt)
+            options[opt] = value
 
-    if not parser.has_section('distroinfo'):
-        parser.add_section('distroinfo')
-    options['patches_repo_key'] = parser.get('distroinfo', 'patches_repo_key')
+    distroinfo_section = (
+        'distroinfo' if parser.has_section('distroinfo') else 'DEFAULT'
+    )
+    options['patches_repo_key'] = parser.get(distroinfo_section,
+                                             'patches_repo_key')
 
     return RebaserConfig(**options)
 
@@ -220,10 +423,12 @@ def set_up_git_config(name, email):
 
     This is a pre-requisite for performing a git rebase operation.
     """
-    os.environ["GIT_AUTHOR_NAME"] = name
-    os.environ["GIT_AUTHOR_EMAIL"] = email
-    os.environ["GIT_COMMITTER_NAME"] = name
-    os.environ["GIT_COMMITTER_EMAIL"] = email
+    os.environ.update({
+        "GIT_AUTHOR_NAME": name,
+        "GIT_AUTHOR_EMAIL": email,
+        "GIT_COMMITTER_NAME": name,
+        "GIT_COMMITTER_EMAIL": email,
+    })
 
 
 def generate_gitreview(path, project, host, port, branch, remote):
@@ -236,34 +441,52 @@ def generate_gitreview(path, project, host, port, branch, remote):
         :param str branch: Git branch to use as defaultbranch
         :param str remote: Git remote to use as defaultremote
     """
+    content = "\n".join([
+        "[gerrit]",
+        "host=%s" % host,
+        "port=%s" % port,
+        "project=%s.git" % project,
+        "defaultbranch=%s" % branch,
+        "defaultremote=%s" % remote,
+        "defaultrebase=1",
+        "",
+    ])
     with open(os.path.join(path, '.gitreview'), 'w') as fp:
-        fp.write("[gerrit]\n")
-        fp.write("host=%s\n" % host)
-        fp.write("port=%s\n" % port)
-        fp.write("project=%s.git\n" % project)
-        fp.write("defaultbranch=%s\n" % branch)
-        fp.write("defaultremote=%s\n" % remote)
-        fp.write("defaultrebase=1\n")
+        fp.write(content)
 
 
-def _rebuild_gitreview(repo, remote, branch):
-    dlrn = get_dlrn_variables()
-    url = repo.repo.remote(remote).url
-    if isinstance(url, list):
-        url = url[0]
+def _gitreview_context(repo, remote):
+    """Return the (path, project, host, port) used to write .gitreview"""
+    url = _remote_url(repo, remote)
     host, port, project = parse_gerrit_remote_url(url)
-    generate_gitreview(dlrn.local_repo, project, host, port, branch,
-                       remote)
+    return repo.repo.working_dir, project, host, port
+
+
+def _rebuild_gitreview(repo, remote, branch, context=None):
+    """Write and commit a .gitreview pointing to the given remote.
+
+    Returns the .gitreview context used, which callers can pass back in
+    on later calls to skip looking it up again.
+    """
+    if context is None:
+        context = _gitreview_context(repo, remote)
+    generate_gitreview(*context, branch, remote)
     # Now push the change
     repo.commit.commit('RHOS:  use internal gerrit - DROP-IN-RPM\n\n'
                        'Change-Id: I400187d0e03127743aad09d859988991'
                        'e965ff7e')
+    return context
 
 
 class Rebaser(object):
 
+    # Fetches younger than this many seconds are considered up to date
+    fetch_max_age = FETCH_MAX_AGE
+
     def __init__(self, repo, branch, commit, remote, timestamp,
-                 dev_mode=True, max_retries=3, release='unknown'):
+                 dev_mode=True, max_retries=3, release='unknown',
+                 partial_fetch=False, base_delay=1.0, max_delay=30.0,
+                 factor=2.0, jitter=0.1, lock_dir=None):
         """Initialize the Rebaser
 
        :param git_wrapper.GitRepo repo: An initialized GitWrapper repo
@@ -275,66 +498,173 @@ class Rebaser(object):
        :param int max_retries: How many retry attempts if remote changed during
                                rebase
        :param str release: Used in the tag name, informational only
+       :param bool partial_fetch: Whether to skip blobs when fetching the
+                                  remote (--filter=blob:none). Blobs are
+                                  then only downloaded lazily, for the
+                                  files git needs to look at during the
+                                  rebase. Falls back to a full fetch if
+                                  the remote doesn't support filtering.
+                                  Note this permanently turns the local
+                                  repo into a partial clone: git records
+                                  the remote as a promisor and later
+                                  fetches from it stay blobless.
+       :param float base_delay: Seconds to wait before the first retry
+       :param float max_delay: Upper bound for the wait between retries
+       :param float factor: Multiplier applied to the wait on each retry
+       :param float jitter: Random fraction by which each wait may vary
+       :param str lock_dir: Where to keep the lock files, LOCK_DIR if unset
         """
         self.repo = repo
         self.branch = branch
         self.commit = commit
         self.remote = remote
         self.timestamp = timestamp
-        self.tag_name = (
-            "private-rebaser-{release}-{timestamp}-previous".format(
-                release=release, timestamp=timestamp)
-        )
+        # These names get passed to git over and over, intern them
+        self.tag_name = sys.intern(
+            f"private-rebaser-{release}-{timestamp}-previous")
         self.dev_mode = dev_mode
         self.max_retries = max_retries
-
-        self.remote_branch = "{0}/{1}".format(self.remote, self.branch)
+        self.partial_fetch = partial_fetch
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.lock_dir = lock_dir
+        # Seeded from the OS, so concurrent workers get different delays
+        self._random = random.Random()
+        self._gitreview_context = None
+
+        self.remote_branch = sys.intern(f"{self.remote}/{self.branch}")
 
     def rebase_and_update_remote(self):
-        """Rebase the local branch to the specific commit & push the result."""
-        self.repo.remote.fetch(self.remote)
+        """Rebase the local branch to the specific commit & push the result.
+
+        Runs with a host-wide lock on the remote branch held, so that
+        workers updating the same branch take turns instead of making
+        each other retry.
+        """
+        url = _remote_url(self.repo, self.remote)
+        with locked(f"{url} {self.branch}", self.lock_dir):
+            self._rebase_and_update_remote()
+
+    def _rebase_and_update_remote(self):
+        if not fetched_recently(self.repo, self.remote, self.fetch_max_age):
+            self.fetch_remote()
+
+        # Nothing to rebase if the remote branch is already at the commit
+        if self.repo.commit.same(self.remote_branch, self.commit):
+            LOGGER.info("%s is already at %s, nothing to do",
+                        self.remote_branch, self.commit)
+            return
 
-        # Reset the local branch to the latest
-        self.repo.branch.create(self.branch,
-                                self.remote_branch,
-                                reset_if_exists=True)
+        self.enable_commit_graph()
+
+        for attempt in range(self.max_retries + 1):
+            # On retries, fetch again: the remote may have changed some
+            # more while we were waiting
+            if attempt:
+                self.fetch_remote()
+
+            # Reset the local branch to the latest
+            self.repo.branch.create(self.branch,
+                                    self.remote_branch,
+                                    reset_if_exists=True)
+
+            # Tag the previous branch's HEAD, before rebase. The tag is
+            # moved if it already exists, e.g. from a previous attempt.
+            self.repo.git.tag("-f", self.tag_name, self.remote_branch)
+
+            # Rebase
+            self.perform_rebase()
+
+            # Check if any new changes have come in
+            self.fetch_remote()
+
+            if self.repo.commit.same(self.tag_name, self.remote_branch):
+                # No new stuff, push it on. The remote can still change
+                # between the fetch and the push, in which case the push
+                # is rejected and we try again.
+                try:
+                    self.update_remote_patches_branch()
+                    return
+                except RemoteChangedException as e:
+                    LOGGER.info("Push rejected, remote changed: %s", e)
+
+            remaining = self.max_retries - attempt
+            if remaining > 0:
+                delay = self.retry_delay(attempt)
+                LOGGER.info("Remote changed during rebase. Remaining "
+                            "attempts: %s, retrying in %.1fs",
+                            remaining, delay)
+                time.sleep(delay)
+
+        # The remote changed several times while we were trying
+        # to push the rebase result back. We stop trying for
+        # now but leave the rebase results as is, so that the
+        # build is still as up-to-date as can be. The patches
+        # branch will be temporarily out of date, but that will
+        # be corrected during the next Rebaser run.
+        LOGGER.warning(
+            "Remote changed multiple times during rebase, not pushing."
+            " The build will include the current rebase result."
+        )
 
-        # Tag the previous branch's HEAD, before rebase
-        self.repo.tag.create(self.tag_name, self.remote_branch)
+    def retry_delay(self, attempt):
+        """Return how long to wait before retrying after the given attempt.
 
-        # Rebase
-        self.perform_rebase()
+        The delay grows exponentially up to max_delay, with random jitter
+        so that workers racing on the same branch don't retry in lockstep.
+        """
+        delay = min(self.max_delay, self.base_delay * self.factor ** attempt)
+        return delay * (1 + self._random.uniform(-self.jitter, self.jitter))
+
+    def fetch_remote(self):
+        """Fetch the remote, without blobs or tags if partial_fetch is set."""
+        from git import GitCommandError
+
+        if self.partial_fetch:
+            try:
+                self.repo.git.fetch(self.remote, "--filter=blob:none",
+                                    "--no-tags")
+                return
+            except GitCommandError as e:
+                LOGGER.warning("Partial fetch from %s failed, falling back "
+                               "to a full fetch: %s", self.remote, e)
+                self.partial_fetch = False
 
-        # Check if any new changes have come in
         self.repo.remote.fetch(self.remote)
 
-        if not self.repo.commit.same(self.tag_name, self.remote_branch):
-            if self.max_retries > 0:
-                LOGGER.info("Remote changed during rebase. Remaining "
-                            "attempts: %s", self.max_retries)
-                time.sleep(20)
-                self.max_retries -= 1
+    def enable_commit_graph(self):
+        """Write a commit-graph file and keep it up to date on fetch.
 
-                # We'll need to move the tag to the new HEAD
-                self.repo.tag.delete(self.tag_name)
-                self.rebase_and_update_remote()
-            else:
-                # The remote changed several times while we were trying
-                # to push the rebase result back. We stop trying for
-                # now but leave the rebase results as is, so that the
-                # build is still as up-to-date as can be. The patches
-                # branch will be temporarily out of date, but that will
-                # be corrected during the next Rebaser run.
-                LOGGER.warning(
-                    "Remote changed multiple times during rebase, not pushing."
-                    " The build will include the current rebase result."
-                )
-        else:
-            # No new stuff, push it on
-            self.update_remote_patches_branch()
+        The commit-graph speeds up the reachability queries behind
+        commit.same and cherry_on_head_only. Failing to write it is not
+        fatal, it only means those queries take the slow path.
+
+        This is only done once per repo: after that, fetch.writeCommitGraph
+        keeps the graph up to date as new commits come in.
+        """
+        from git import GitCommandError
+
+        info_dir = os.path.join(self.repo.repo.git_dir, 'objects', 'info')
+        if (os.path.exists(os.path.join(info_dir, 'commit-graph')) or
+                os.path.exists(os.path.join(info_dir, 'commit-graphs',
+                                            'commit-graph-chain'))):
+            return
+
+        try:
+            self.repo.git.config("core.commitGraph", "true")
+            self.repo.git.config("fetch.writeCommitGraph", "true")
+            self.repo.git.config("gc.writeCommitGraph", "true")
+            self.repo.git.commit_graph("write", "--reachable",
+                                       "--changed-paths")
+        except GitCommandError as e:
+            LOGGER.warning("Could not write commit-graph: %s", e)
 
     def perform_rebase(self):
         """Rebase the specific local branch to the specific commit."""
+        from git_wrapper import exceptions as git_exceptions
+
         rebase_done = False
         while not rebase_done:
             try:
@@ -359,13 +689,42 @@ class Rebaser(object):
                            "to rebase, skipping it.")
             try:
                 self.repo.git.rebase('--skip')
-                _rebuild_gitreview(self.repo, self.remote, self.branch)
+                self._gitreview_context = _rebuild_gitreview(
+                    self.repo, self.remote, self.branch,
+                    self._gitreview_context)
                 return True
             except Exception as e:
                 LOGGER.error("Failed to fix rebase error: %s" % e)
                 return False
         return False
 
+    def _retrying_push(self, *args, attempts=5, base=0.5):
+        """Run git push, retrying with backoff if it fails.
+
+        Unlike a rebase, a push can safely be retried, e.g. after a
+        network hiccup or a ref lock held on the remote. The exception
+        from the last attempt is raised if all of them fail.
+
+        Rejected pushes are not retried, as they would be rejected again.
+        RemoteChangedException is raised if the remote branch moved.
+        """
+        from git import GitCommandError
+
+        for attempt in range(attempts):
+            try:
+                return self.repo.git.push(*args)
+            except GitCommandError as e:
+                stderr = str(e.stderr)
+                if any(err in stderr for err in REMOTE_CHANGED_ERRORS):
+                    raise RemoteChangedException(stderr.strip()) from e
+                if 'rejected' in stderr or attempt == attempts - 1:
+                    raise
+                delay = min(30, base * 2 ** attempt) + \
+                    self._random.random() * 0.5
+                LOGGER.warning("Push to %s failed, retrying in %.1fs: %s",
+                               self.remote, delay, e)
+                time.sleep(delay)
+
     def update_remote_patches_branch(self):
         """Force push local patches branch to the remote repository.
 
@@ -379,37 +738,48 @@ class Rebaser(object):
         #    meantime, the contents may be the same but we still need
         #    to push and to remove the downstream-only patch and align
         #    the commit hash with upstream
-        commit_on_remote = self.repo.branch.remote_contains(
-            self.remote_branch, self.commit)
+        local_only, commit_on_remote = _parallel_git(
+            partial(self.repo.branch.cherry_on_head_only,
+                    self.remote_branch, self.branch),
+            partial(self.repo.branch.remote_contains,
+                    self.remote_branch, self.commit)
+        )
 
-        if not self.repo.branch.cherry_on_head_only(
-                self.remote_branch, self.branch) and commit_on_remote:
+        if not local_only and commit_on_remote:
             LOGGER.info("Deleting tag without pushing (no changes)")
             self.repo.tag.delete(self.tag_name)
             return
 
-        if self.dev_mode:
-            LOGGER.warning("Dev mode: executing push commands in dry-run mode")
-            self.repo.git.push("-n", self.remote, self.tag_name)
-            self.repo.git.push("-nf", "--follow-tags", self.remote,
-                               self.branch)
-        else:
-            LOGGER.warning(
-                "Force-pushing {branch} to {remote} ({timestamp})".format(
-                    branch=self.branch,
-                    remote=self.remote,
-                    timestamp=self.timestamp
+        # Push the tag and force-push the branch in a single atomic
+        # invocation. The force-push only goes through if the remote
+        # branch is still at the tagged commit, so that changes merged in
+        # the meantime are never overwritten.
+        lease = f"--force-with-lease=refs/heads/{self.branch}:{self.tag_name}"
+        refspecs = (
+            f"refs/tags/{self.tag_name}",
+            f"refs/heads/{self.branch}:refs/heads/{self.branch}",
+        )
+        with _repo_lock(self.repo.repo.working_dir):
+            if self.dev_mode:
+                LOGGER.warning(
+                    "Dev mode: executing push commands in dry-run mode")
+                self._retrying_push("-n", "--atomic", lease, self.remote,
+                                    *refspecs)
+            else:
+                LOGGER.warning(
+                    f"Force-pushing {self.branch} to {self.remote} "
+                    f"({self.timestamp})"
                 )
-            )
-            self.repo.git.push(self.remote, self.tag_name)
-            self.repo.git.push("-f", "--follow-tags", self.remote, self.branch)
+                self._retrying_push("--atomic", lease, self.remote,
+                                    *refspecs)
 
 
 def get_dlrn_variables():
     """Return environment variables that are set by DLRN"""
     DLRNConfig = namedtuple(
         'DLRNConfig',
-        ['user', 'local_repo', 'commit', 'distroinfo_repo', 'pkg_name']
+        ['user', 'local_repo', 'commit', 'distroinfo_repo', 'pkg_name',
+         'patches_branch']
     )
 
     return DLRNConfig(
@@ -417,37 +787,36 @@ def get_dlrn_variables():
         os.environ['DLRN_SOURCEDIR'],
         os.environ['DLRN_SOURCE_COMMIT'],
         os.environ['DLRN_DISTROINFO_REPO'],
-        os.environ['DLRN_PACKAGE_NAME']
+        os.environ['DLRN_PACKAGE_NAME'],
+        os.environ.get('PATCHES_BRANCH', None)
     )
 
 
-def main():
-    dlrn = get_dlrn_variables()
-
-    # Default values for options in patch_rebaser.ini
-    defaults = {
-        'remote_name': 'remote_name',
-        'git_name': 'Your Name',
-        'git_email': 'you@example.com',
-        'packages_to_process': '',
-        'dlrn_projects_ini': (
-            '/usr/local/share/dlrn/{0}/projects.ini'.format(dlrn.user)),
-        'dev_mode': 'true',
-        'patches_repo_key': 'patches',
-        'create_patches_branch': 'false'
-    }
+def process_package(config, dlrn):
+    """Rebase the patches branch of a single DLRN package.
 
-    config = get_rebaser_config(defaults)
+    Returns the name of the patches branch, or None if there was nothing
+    to rebase.
 
+       :param RebaserConfig config: patch_rebaser configuration
+       :param DLRNConfig dlrn: DLRN variables for the package
+    """
     if config.packages_to_process and \
        dlrn.pkg_name not in config.packages_to_process:
         LOGGER.info(
             "Skipping %s, as package not in list of packages_to_process",
             dlrn.pkg_name
         )
-        return
+        return None
 
-    set_up_git_config(config.git_name, config.git_email)
+    # Only one worker at a time may touch a given local repo
+    with _repo_lock(dlrn.local_repo):
+        return _process_package(config, dlrn)
+
+
+def _process_package(config, dlrn):
+    from git_wrapper import exceptions as git_exceptions
+    from git_wrapper.repo import GitRepo
 
     repo = GitRepo(dlrn.local_repo)
 
@@ -456,20 +825,35 @@ def main():
         dlrn.distroinfo_repo, dlrn.pkg_name, config.patches_repo_key
     )
     if not patches_repo:
-        return
+        return None
 
-    if config.remote_name not in repo.remote.names():
+    remote_names = frozenset(repo.remote.names())
+    if config.remote_name not in remote_names:
         if not repo.remote.add(config.remote_name, patches_repo):
             raise Exception(
-                "Could not add remote {0} ({1})".format(config.remote_name,
-                                                        patches_repo)
+                f"Could not add remote {config.remote_name} ({patches_repo})"
             )
-    repo.remote.fetch_all()
+
+    # Fetch the patches remote last, so the Rebaser sees it was just
+    # fetched and doesn't need to fetch it again. Like fetch_all, all
+    # the remotes are fetched even if one fails.
+    errors = []
+    for remote in sorted(remote_names - {config.remote_name}) + \
+            [config.remote_name]:
+        try:
+            fetch_if_stale(repo, remote)
+        except git_exceptions.RemoteException:
+            LOGGER.exception("Error fetching remote %s", remote)
+            errors.append(remote)
+    if errors:
+        raise git_exceptions.RemoteException(
+            f"Error fetching these remotes: {', '.join(errors)}")
 
     # Create local patches branch
     branch_name = get_patches_branch(repo,
                                      config.remote_name,
-                                     config.dlrn_projects_ini)
+                                     config.dlrn_projects_ini,
+                                     dlrn.patches_branch)
 
     # Not every project has a -patches branch for every release
     if not branch_name:
@@ -477,7 +861,7 @@ def main():
             LOGGER.warning('Patches branch does not exist, creating it')
             branch_name = create_patches_branch(
                 repo, dlrn.commit, config.remote_name,
-                dev_mode=config.dev_mode)
+                dev_mode=config.dev_mode, branch_name=dlrn.patches_branch)
             if not branch_name:
                 raise Exception('Could not create -patches branch')
         else:
@@ -485,7 +869,7 @@ def main():
 
         # We do not need to rebase now, since the branch was
         # created on using the upstream commit as a HEAD
-        return
+        return branch_name
 
     # Timestamp that will be used to tag the previous branch tip
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
@@ -500,9 +884,37 @@ def main():
                       config.remote_name,
                       timestamp,
                       config.dev_mode,
-                      release=release)
+                      release=release,
+                      partial_fetch=config.partial_fetch,
+                      lock_dir=config.lock_dir)
 
     rebaser.rebase_and_update_remote()
+    return branch_name
+
+
+def main():
+    dlrn = get_dlrn_variables()
+
+    # Default values for options in patch_rebaser.ini
+    defaults = {
+        'remote_name': 'remote_name',
+        'git_name': 'Your Name',
+        'git_email': 'you@example.com',
+        'packages_to_process': '',
+        'dlrn_projects_ini': (
+            f'/usr/local/share/dlrn/{dlrn.user}/projects.ini'),
+        'dev_mode': 'true',
+        'patches_repo_key': 'patches',
+        'create_patches_branch': 'false',
+        'partial_fetch': 'false',
+        'lock_dir': LOCK_DIR
+    }
+
+    config = get_rebaser_config(defaults)
+
+    set_up_git_config(config.git_name, config.git_email)
+
+    process_package(config, dlrn)
 
 
 if __name__ == "__main__":
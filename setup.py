@@ -9,9 +9,10 @@ with open('README.rst') as readme_file:
     readme = readme_file.read()
 
 requirements = [ 'Distroinfo>=0.1',
+                 'GitPython',
                  'git_wrapper>=0.2.2' ]
 
-test_requirements = [ 'mock', 'pytest', ]
+test_requirements = [ 'pytest', ]
 
 setup(
     author="Release Depot",
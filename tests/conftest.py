@@ -1,51 +1,90 @@
 #! /usr/bin/env python
 """Base fixtures for unit tests"""
 
-import os
+import time
+from unittest.mock import Mock
 
-from mock import Mock, patch
 import pytest
 
+import patch_rebaser.patch_rebaser
+
+
+@pytest.fixture(autouse=True, scope="session")
+def _no_sleep():
+    """Don't wait between retries, in any test"""
+    sleep = time.sleep
+    time.sleep = lambda s: None
+    yield
+    time.sleep = sleep
+
+
+@pytest.fixture(autouse=True)
+def lock_dir(tmp_path, monkeypatch):
+    """Keep lock files created during tests out of the system lock dir"""
+    monkeypatch.setattr(patch_rebaser.patch_rebaser, 'LOCK_DIR',
+                        str(tmp_path))
+    return tmp_path
+
+
+# git.cmd.Git runs any attribute as a git subcommand, so it can't be used
+# as a spec. List the subcommands patch_rebaser calls instead.
+GIT_COMMANDS = ('checkout', 'commit_graph', 'config', 'fetch', 'for_each_ref',
+                'ls_remote', 'push', 'rebase', 'tag')
+
 
 @pytest.fixture
-def mock_repo():
+def mock_repo(tmp_path):
     repo_mock = Mock()
-    repo_mock.attach_mock(Mock(), 'git')
+    repo_mock.attach_mock(Mock(spec_set=GIT_COMMANDS), 'git')
+    repo_mock.repo.git_dir = str(tmp_path)
+    repo_mock.repo.working_dir = str(tmp_path)
     return repo_mock
 
 
 @pytest.fixture
-def mock_env(monkeypatch):
-    monkeypatch.setitem(os.environ, 'DLRN_USER', 'TEST_USER')
-    monkeypatch.setitem(os.environ, 'DLRN_SOURCEDIR', 'TEST_SOURCEDIR')
-    monkeypatch.setitem(os.environ, 'DLRN_SOURCE_COMMIT', '123456a')
-    monkeypatch.setitem(os.environ, 'DLRN_DISTROINFO_REPO', 'TEST_DI_REPO')
-    monkeypatch.setitem(os.environ, 'DLRN_PACKAGE_NAME', 'TEST_PACKAGE')
-    monkeypatch.setitem(os.environ, 'PATCHES_BRANCH', 'test-patches')
+def rebaser(request, mock_repo):
+    """A Rebaser working on mock_repo.
+
+    Tests can override the constructor arguments by parametrizing this
+    fixture indirectly with a dict of keyword arguments.
+    """
+    kwargs = dict(repo=mock_repo, branch="my_branch", commit="my_commit",
+                  remote="my_remote", timestamp="my_tstamp", dev_mode=True)
+    kwargs.update(getattr(request, 'param', {}))
+    return patch_rebaser.patch_rebaser.Rebaser(**kwargs)
 
 
 @pytest.fixture
-def mock_config(datadir):
-    patcher = patch('os.path.realpath',
-                    return_value=str(datadir/'test_config.ini'))
-    patcher.start()
-    yield
-    patcher.stop()
+def mock_rebuild_gitreview(monkeypatch):
+    rebuild_mock = Mock()
+    monkeypatch.setattr(patch_rebaser.patch_rebaser, '_rebuild_gitreview',
+                        rebuild_mock)
+    return rebuild_mock
+
+
+_ENV = {
+    'DLRN_USER': 'TEST_USER',
+    'DLRN_SOURCEDIR': 'TEST_SOURCEDIR',
+    'DLRN_SOURCE_COMMIT': '123456a',
+    'DLRN_DISTROINFO_REPO': 'TEST_DI_REPO',
+    'DLRN_PACKAGE_NAME': 'TEST_PACKAGE',
+    'PATCHES_BRANCH': 'test-patches',
+}
 
 
 @pytest.fixture
-def mock_config_with_pkgs_to_process(datadir):
-    patcher = patch('os.path.realpath',
-                    return_value=str(datadir/'pkgs_to_process_config.ini'))
-    patcher.start()
-    yield
-    patcher.stop()
+def mock_env(monkeypatch):
+    for name, value in _ENV.items():
+        monkeypatch.setenv(name, value)
 
 
 @pytest.fixture
-def mock_config_with_create_patches_branch(datadir):
-    patcher = patch('os.path.realpath',
-                    return_value=str(datadir/'test_config_create_branch.ini'))
-    patcher.start()
-    yield
-    patcher.stop()
+def mock_config(request, datadir, monkeypatch):
+    """Point patch_rebaser at a test config file.
+
+    Defaults to test_config.ini; tests can pick another file from the
+    data dir by parametrizing this fixture indirectly.
+    """
+    fname = getattr(request, 'param', 'test_config.ini')
+    monkeypatch.setattr(patch_rebaser.patch_rebaser, 'CONFIG_FILE',
+                        str(datadir/fname))
@@ -1,172 +1,315 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import configparser
+import os
+import threading
 import time
+from unittest.mock import MagicMock, Mock, patch
 
-from git_wrapper import exceptions
-from mock import MagicMock, Mock
-import mock
+import distroinfo.info
+from git import GitCommandError
+from git_wrapper.exceptions import RebaseException, RemoteException
+import git_wrapper.repo
+from git_wrapper.repo import GitRepo
 import pytest
 
 import patch_rebaser
 from patch_rebaser.patch_rebaser import (
+    _patches_branch_candidates,
+    _repo_lock,
+    clear_distro_info_cache,
     create_patches_branch,
+    fetch_if_stale,
     find_patches_branch,
+    generate_gitreview,
+    get_dlrn_projects,
+    get_distro_info,
+    get_downstream_distgit_branch,
     get_rebaser_config,
+    get_rebaser_configparser,
+    locked,
     get_release_from_branch_name,
     main,
     parse_distro_info_path,
     parse_gerrit_remote_url,
     Rebaser,
+    RemoteChangedException,
 )
 
 
-def test_find_patches_branch():
-    branches = {
-        "xxxx-154.23-zzzz-1": "xxxx-154.23-patches",
-        "xxxx-90.0-zzzz-1-trunk": "xxxx-90.0-trunk-patches",
-        "xxxx-1.0-zzzz-1": "xxxx-1.0-patches"
-    }
+# Push refspec for the "my_branch" branch used by the rebaser fixture
+BRANCH_REFSPEC = "refs/heads/my_branch:refs/heads/my_branch"
 
-    def mock_branch_exists(branch, remote):
-        if branch in branches.values():
-            return True
-        else:
-            return False
+PATCHES_BRANCHES = {
+    "xxxx-154.23-zzzz-1": "xxxx-154.23-patches",
+    "xxxx-90.0-zzzz-1-trunk": "xxxx-90.0-trunk-patches",
+    "xxxx-1.0-zzzz-1": "xxxx-1.0-patches"
+}
 
-    mock_repo = Mock()
-    mock_repo.branch.exists = mock_branch_exists
 
-    for distgit, patches in branches.items():
-        assert patches == find_patches_branch(mock_repo, "", distgit)
+@pytest.mark.parametrize("distgit,patches", PATCHES_BRANCHES.items())
+def test_find_patches_branch(mock_repo, distgit, patches):
+    mock_repo.git.for_each_ref.return_value = "\n".join(
+        "refs/remotes/my_remote/%s" % branch
+        for branch in ["HEAD", "master"] + list(PATCHES_BRANCHES.values())
+    )
+
+    assert patches == find_patches_branch(mock_repo, "my_remote", distgit)
+    mock_repo.branch.exists.assert_not_called()
+    mock_repo.git.ls_remote.assert_not_called()
+
+
+def test_find_patches_branch_not_fetched(mock_repo):
+    """
+    GIVEN a repository where the remote was never fetched
+    WHEN find_patches_branch is called
+    THEN the remote branches are listed with a single ls-remote
+    """
+    mock_repo.git.for_each_ref.return_value = ""
+    mock_repo.git.ls_remote.return_value = "\n".join(
+        "%040d\trefs/heads/%s" % (i, branch)
+        for i, branch in enumerate(["master", "xxxx-1.0-patches"])
+    )
 
+    assert "xxxx-1.0-patches" == find_patches_branch(mock_repo, "my_remote",
+                                                     "xxxx-1.0-zzzz-1")
+    mock_repo.git.ls_remote.assert_called_once_with("--heads", "my_remote")
+
+
+def test_patches_branch_candidates():
+    assert _patches_branch_candidates("rhos-17.0-rhel-9-trunk") == [
+        "rhos-17.0-rhel-9-trunk-trunk-patches",
+        "rhos-17.0-rhel-9-trunk-patches",
+        "rhos-17.0-rhel-trunk-patches",
+        "rhos-17.0-trunk-patches",
+        "rhos-trunk-patches",
+    ]
+    assert _patches_branch_candidates("rhos-17.0-rhel-9") == [
+        "rhos-17.0-rhel-9-patches",
+        "rhos-17.0-rhel-patches",
+        "rhos-17.0-patches",
+        "rhos-patches",
+    ]
+
+
+# Result form: file, path, remote boolean
+@pytest.mark.parametrize("path,result", [
+    ("/home/dlrn/di/test.yaml", ("test.yaml", "/home/dlrn/di", False)),
+    ("https://example.com/info/info.yml", ("info.yml",
+                                           "https://example.com/info",
+                                           True)),
+])
+def test_parse_distro_info_path(path, result):
+    assert parse_distro_info_path(path) == result
+
+
+def test_get_distro_info_is_cached(monkeypatch):
+    """
+    GIVEN a distroinfo repo path
+    WHEN get_distro_info is called several times with that path
+    THEN the distroinfo repo is only loaded once
+    AND clear_distro_info_cache forces it to be loaded again
+    """
+    mock_distroinfo = Mock()
+    monkeypatch.setattr(distroinfo.info, 'DistroInfo', mock_distroinfo)
+    clear_distro_info_cache()
 
-def test_parse_distro_info_path():
-    # Result form: file, path, remote boolean
-    data = {
-        "/home/dlrn/di/test.yaml": ("test.yaml", "/home/dlrn/di", False),
-        "https://example.com/info/info.yml": ("info.yml",
-                                              "https://example.com/info",
-                                              True),
-    }
+    first = get_distro_info("/home/dlrn/di/test.yaml")
+    assert get_distro_info("/home/dlrn/di/test.yaml") is first
+    assert mock_distroinfo.call_count == 1
 
-    for path, result in data.items():
-        assert parse_distro_info_path(path) == result
+    clear_distro_info_cache()
+    get_distro_info("/home/dlrn/di/test.yaml")
+    assert mock_distroinfo.call_count == 2
+    clear_distro_info_cache()
 
 
-def test_update_remote_patches_branch_no_changes_with_remote(mock_repo):
+def test_get_distro_info_remote_expires(monkeypatch):
+    """
+    GIVEN a remote distroinfo repo url
+    WHEN get_distro_info is called again after DISTRO_INFO_TTL seconds
+    THEN the distroinfo repo is loaded again
+    """
+    mock_distroinfo = Mock()
+    monkeypatch.setattr(distroinfo.info, 'DistroInfo', mock_distroinfo)
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    clear_distro_info_cache()
+
+    get_distro_info("https://example.com/info/info.yml")
+    now[0] += 299
+    get_distro_info("https://example.com/info/info.yml")
+    assert mock_distroinfo.call_count == 1
+
+    now[0] += 2
+    get_distro_info("https://example.com/info/info.yml")
+    assert mock_distroinfo.call_count == 2
+    clear_distro_info_cache()
+
+
+@pytest.mark.parametrize("commit_on_remote,pushed", [
+    (True, False),
+    (False, True),
+])
+def test_update_remote_patches_branch_no_changes(
+        mock_repo, rebaser, commit_on_remote, pushed):
     """
     GIVEN Rebaser initialized correctly
     WHEN update_remote_patches_branch is called
     AND cherry_on_head_only returns false (indicating the local and remote
         branches have no differences)
-    THEN tag.delete is called
-    AND git.push is not called
+    THEN git.push is only called if branch.remote_contains returns false
+        (indicating the remote is missing an upstream commit)
+    AND tag.delete is called otherwise
     """
     mock_repo.branch.cherry_on_head_only.return_value = False
+    mock_repo.branch.remote_contains.return_value = commit_on_remote
+
+    rebaser.update_remote_patches_branch()
+
+    assert mock_repo.git.push.called is pushed
+    assert mock_repo.tag.delete.called is not pushed
+
+
+@pytest.mark.parametrize("rebaser,push_args", [
+    # dev_mode pushes with -n, for a dry-run
+    ({"timestamp": "2019", "release": "2.1"},
+     ("-n", "--atomic",
+      "--force-with-lease=refs/heads/my_branch:"
+      "private-rebaser-2.1-2019-previous",
+      "my_remote", "refs/tags/private-rebaser-2.1-2019-previous")),
+    ({"timestamp": "2019", "dev_mode": False},
+     ("--atomic",
+      "--force-with-lease=refs/heads/my_branch:"
+      "private-rebaser-unknown-2019-previous",
+      "my_remote", "refs/tags/private-rebaser-unknown-2019-previous")),
+], indirect=["rebaser"])
+def test_update_remote_patches_branch_with_changes(
+        mock_repo, rebaser, push_args):
+    """
+    GIVEN Rebaser initialized correctly
+    WHEN update_remote_patches_branch is called
+    AND cherry_on_head_only returns local changes
+    THEN tag.delete is not called
+    AND git.push is called once, with -n only if dev_mode is set
+    AND the branch is only force-pushed if the remote is still at the tag
+    """
+    mock_repo.branch.cherry_on_head_only.return_value = True
 
-    rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
-                      "my_tstamp", dev_mode=True)
     rebaser.update_remote_patches_branch()
 
-    mock_repo.tag.delete.assert_called_once()
-    assert mock_repo.git.push.called is False
+    assert mock_repo.tag.delete.called is False
+    mock_repo.git.push.assert_called_once_with(*push_args, BRANCH_REFSPEC)
 
 
-def test_update_remote_patches_branch_no_changes_but_missing_commit(mock_repo):
+def test_update_remote_patches_branch_retries_push(mock_repo):
     """
     GIVEN Rebaser initialized correctly
     WHEN update_remote_patches_branch is called
-    AND cherry_on_head_only returns false (indicating the local and remote
-        branches have no differences)
-    AND branch.remote_contains returns false (indicating the remote is missing
-        an upstream commit)
-    THEN git.push is called
+    AND git.push fails a couple of times before succeeding
+    THEN git.push is retried until it succeeds
     """
-    mock_repo.branch.cherry_on_head_only.return_value = False
-    mock_repo.branch.remote_contains.return_value = False
+    mock_repo.branch.cherry_on_head_only.return_value = True
+    mock_repo.git.push.side_effect = [GitCommandError("push", 1),
+                                      GitCommandError("push", 1),
+                                      None]
 
     rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
-                      "my_tstamp", dev_mode=True)
+                      "2019", dev_mode=False)
     rebaser.update_remote_patches_branch()
 
-    assert mock_repo.git.push.called is True
+    assert mock_repo.git.push.call_count == 3
 
 
-def test_update_remote_patches_branch_no_changes_and_commit_present(mock_repo):
+def test_update_remote_patches_branch_push_gives_up(mock_repo):
     """
     GIVEN Rebaser initialized correctly
     WHEN update_remote_patches_branch is called
-    AND cherry_on_head_only returns false (indicating the local and remote
-        branches have no differences)
-    AND branch.remote_contains returns true
-    THEN git.push is not called
+    AND git.push keeps failing
+    THEN the error is raised after 5 attempts
     """
-    mock_repo.branch.cherry_on_head_only.return_value = False
-    mock_repo.branch.remote_contains.return_value = True
+    mock_repo.branch.cherry_on_head_only.return_value = True
+    mock_repo.git.push.side_effect = GitCommandError("push", 1)
 
     rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
-                      "my_tstamp", dev_mode=True)
-    rebaser.update_remote_patches_branch()
+                      "2019", dev_mode=False)
+    with pytest.raises(GitCommandError):
+        rebaser.update_remote_patches_branch()
 
-    assert mock_repo.git.push.called is False
+    assert mock_repo.git.push.call_count == 5
 
 
-def test_update_remote_patches_branch_with_dev_mode(mock_repo):
+@pytest.mark.parametrize("stderr", [
+    " ! [rejected]        my_branch -> my_branch (stale info)",
+    " ! [rejected]        my_branch -> my_branch (non-fast-forward)",
+])
+def test_update_remote_patches_branch_remote_changed(mock_repo, stderr):
     """
     GIVEN Rebaser initialized correctly
-    WITH dev_mode set to true
     WHEN update_remote_patches_branch is called
-    THEN tag.delete is not called
-    AND git.push is called with -n argument for dry-run
+    AND git.push is rejected because the remote branch moved
+    THEN git.push is not retried
+    AND RemoteChangedException is raised
     """
     mock_repo.branch.cherry_on_head_only.return_value = True
+    mock_repo.git.push.side_effect = GitCommandError("push", 1, stderr)
 
     rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
-                      "2019", dev_mode=True, release='2.1')
-    rebaser.update_remote_patches_branch()
-
-    # Tag not deleted, and pushed with -n for dry-run
-    assert mock_repo.tag.delete.called is False
-    assert mock_repo.git.push.called is True
+                      "2019", dev_mode=False)
+    with pytest.raises(RemoteChangedException):
+        rebaser.update_remote_patches_branch()
 
-    expected = [(("-n", "my_remote", "private-rebaser-2.1-2019-previous"),),
-                (("-nf", "--follow-tags", "my_remote", "my_branch"),)]
-    assert mock_repo.git.push.call_args_list == expected
+    mock_repo.git.push.assert_called_once()
 
 
-def test_update_remote_patches_branch_without_dev_mode(mock_repo):
+def test_update_remote_patches_branch_push_rejected(mock_repo):
     """
     GIVEN Rebaser initialized correctly
-    WITH dev_mode set to false
     WHEN update_remote_patches_branch is called
-    THEN tag.delete is not called
-    AND git.push is called without -n
+    AND git.push is rejected by the remote, e.g. by a hook
+    THEN git.push is not retried
+    AND the error is raised
     """
     mock_repo.branch.cherry_on_head_only.return_value = True
+    mock_repo.git.push.side_effect = GitCommandError(
+        "push", 1, " ! [remote rejected] my_branch -> my_branch (hook)")
 
     rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
                       "2019", dev_mode=False)
-    rebaser.update_remote_patches_branch()
+    with pytest.raises(GitCommandError):
+        rebaser.update_remote_patches_branch()
 
-    # Tag not deleted, and pushed without -n
-    assert mock_repo.tag.delete.called is False
-    assert mock_repo.git.push.called is True
+    mock_repo.git.push.assert_called_once()
+
+
+def test_rebase_and_update_remote_retries_rejected_push(mock_repo, rebaser):
+    """
+    GIVEN Rebaser initialized correctly
+    WHEN rebase_and_update_remote is called
+    AND the remote changes between the last fetch and the push
+    THEN the rebase is attempted again from the new remote HEAD
+    AND the rebase result is pushed
+    """
+    mock_repo.branch.cherry_on_head_only.return_value = True
+    mock_repo.commit.same.side_effect = [False, True, True]
+    mock_repo.git.push.side_effect = [
+        GitCommandError("push", 1, " ! [rejected] (stale info)"), None]
 
-    expected = [(("my_remote", "private-rebaser-unknown-2019-previous"),),
-                (("-f", "--follow-tags", "my_remote", "my_branch"),)]
-    assert mock_repo.git.push.call_args_list == expected
+    rebaser.rebase_and_update_remote()
+
+    assert mock_repo.branch.rebase_to_hash.call_count == 2
+    assert mock_repo.git.push.call_count == 2
+    assert mock_repo.remote.fetch.call_count == 4
 
 
-def test_perform_rebase(mock_repo):
+def test_perform_rebase(mock_repo, rebaser):
     """
     GIVEN Rebaser initialized correctly including branch and commit
     WHEN perform_rebase is called
     THEN branch.rebase_to_hash is called
     WITH the same branch and commit
     """
-    rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
-                      "my_tstamp", dev_mode=True)
     rebaser.perform_rebase()
 
     mock_repo.branch.rebase_to_hash.assert_called()
@@ -175,104 +318,293 @@ def test_perform_rebase(mock_repo):
     )
 
 
-def test_perform_rebase_aborts_on_failure(mock_repo):
+def test_perform_rebase_aborts_on_failure(mock_repo, rebaser):
     """
     GIVEN Rebaser initialized correctly
     WHEN rebase_to_hash fails with RebaseException
     THEN perform_rebase also raises RebaseException
     AND abort_rebase is called
     """
-    mock_repo.branch.rebase_to_hash.side_effect = exceptions.RebaseException
+    mock_repo.branch.rebase_to_hash.side_effect = RebaseException
 
-    rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
-                      "my_tstamp", dev_mode=True)
-
-    with pytest.raises(exceptions.RebaseException):
+    with pytest.raises(RebaseException):
         rebaser.perform_rebase()
 
     mock_repo.branch.abort_rebase.assert_called()
 
 
-def test_rebase_and_update_remote(mock_repo, monkeypatch):
+def test_locked(lock_dir):
+    """
+    GIVEN a lock held on a name
+    WHEN another thread tries to lock the same name
+    THEN it waits until the first lock is released
+    """
+    events = []
+
+    def second_locker():
+        with locked("my_remote my_branch"):
+            events.append("second")
+
+    with locked("my_remote my_branch"):
+        thread = threading.Thread(target=second_locker)
+        thread.start()
+        thread.join(0.2)
+        events.append("first")
+    thread.join()
+
+    assert events == ["first", "second"]
+    assert len(list(lock_dir.glob("patch_rebaser-*.lock"))) == 1
+
+
+def test_locked_in_lock_dir(lock_dir, tmp_path):
+    """
+    GIVEN a lock directory
+    WHEN locked is called with it
+    THEN the lock file is created there, world readable
+    """
+    other_dir = tmp_path / 'locks'
+    other_dir.mkdir()
+
+    with locked("my_remote my_branch", str(other_dir)):
+        pass
+
+    lock_files = list(other_dir.glob("patch_rebaser-*.lock"))
+    assert len(lock_files) == 1
+    assert lock_files[0].stat().st_mode & 0o444 == 0o444
+    assert not list(lock_dir.glob("patch_rebaser-*.lock"))
+
+
+def test_locked_other_users_lock_file(lock_dir, monkeypatch):
+    """
+    GIVEN a lock file created by another user
+    WHEN locked is called
+    AND the lock file can't be opened with O_CREAT
+    THEN the existing lock file is used
+    """
+    with locked("my_remote my_branch"):
+        pass
+    orig_open = os.open
+
+    def mock_open(path, flags, *args):
+        if flags & os.O_CREAT:
+            raise PermissionError(path)
+        return orig_open(path, flags, *args)
+
+    monkeypatch.setattr(os, 'open', mock_open)
+    with locked("my_remote my_branch"):
+        pass
+
+
+def test_repo_lock_normalizes_path(tmp_path):
+    """
+    GIVEN a repository reachable through several paths
+    WHEN _repo_lock is called with each of them
+    THEN the same lock is returned every time
+    """
+    repo_dir = tmp_path / 'repo'
+    repo_dir.mkdir()
+    (tmp_path / 'link').symlink_to(repo_dir)
+
+    lock = _repo_lock(str(repo_dir))
+    assert _repo_lock(str(repo_dir) + '/') is lock
+    assert _repo_lock(str(tmp_path / 'link')) is lock
+
+
+@pytest.mark.parametrize("rebaser", [{"timestamp": "000", "release": "15.0"}],
+                         indirect=True)
+def test_rebase_and_update_remote(mock_repo, rebaser):
     """
     GIVEN Rebaser initialized correctly
     WHEN rebase_and_update_remote is called
-    THEN a tag is created
-    AND remote.fetch is called twice to catch remote updates during the rebase
+    THEN a tag is created with -f
+    AND the remote is fetched twice to catch updates during the rebase
     AND git.push is called
     """
-    monkeypatch.setattr(time, 'sleep', lambda s: None)
 
+    mock_repo.commit.same.side_effect = [False, True]
+    rebaser.rebase_and_update_remote()
+
+    mock_repo.git.tag.assert_called_once_with(
+        "-f", "private-rebaser-15.0-000-previous", "my_remote/my_branch")
+    assert mock_repo.remote.fetch.call_count == 2
+
+    mock_repo.git.push.assert_called_once_with(
+        "-n", "--atomic",
+        "--force-with-lease=refs/heads/my_branch:"
+        "private-rebaser-15.0-000-previous",
+        "my_remote",
+        "refs/tags/private-rebaser-15.0-000-previous",
+        BRANCH_REFSPEC)
+
+
+def test_rebase_and_update_remote_already_up_to_date(mock_repo):
+    """
+    GIVEN Rebaser initialized correctly
+    WHEN rebase_and_update_remote is called
+    AND the remote branch is already at the commit to rebase to
+    THEN no tag is created
+    AND no rebase is attempted
+    AND git.push is not called
+    """
     rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
-                      "000", dev_mode=True, release='15.0')
+                      "000", dev_mode=True)
 
     mock_repo.commit.same.return_value = True
     rebaser.rebase_and_update_remote()
 
-    assert mock_repo.tag.create.call_count == 1
-    assert mock_repo.remote.fetch.call_count == 2
+    mock_repo.commit.same.assert_called_once_with("my_remote/my_branch",
+                                                  "my_commit")
+    mock_repo.git.tag.assert_not_called()
+    mock_repo.branch.rebase_to_hash.assert_not_called()
+    mock_repo.git.push.assert_not_called()
 
-    expected = [(("-n", "my_remote", "private-rebaser-15.0-000-previous"),),
-                (("-nf", "--follow-tags", "my_remote", "my_branch"),)]
-    assert mock_repo.git.push.call_args_list == expected
+
+def test_rebase_and_update_remote_skips_fresh_fetch(mock_repo, tmp_path):
+    """
+    GIVEN Rebaser initialized correctly
+    WHEN rebase_and_update_remote is called
+    AND the remote was the last one fetched, moments ago
+    THEN the initial fetch is skipped
+    """
+    mock_repo.repo.remote.return_value.url = 'ssh://me@example.com/proj.git'
+    (tmp_path / 'FETCH_HEAD').write_text(
+        "1234abcd\t\tbranch 'my_branch' of ssh://example.com/proj\n")
+
+    rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
+                      "000", dev_mode=True)
+
+    mock_repo.commit.same.side_effect = [False, True]
+    rebaser.rebase_and_update_remote()
+
+    assert mock_repo.remote.fetch.call_count == 1
+
+
+# The second url ends with the remote url, but is a different repo
+@pytest.mark.parametrize("fetched_url", [
+    "/repos/upstream_repo", "/srv/mirror/repos/patches_repo"])
+def test_fetch_if_stale(mock_repo, tmp_path, fetched_url):
+    """
+    GIVEN a repo whose FETCH_HEAD was written by a fetch of another remote
+    WHEN fetch_if_stale is called
+    THEN the remote is fetched
+    """
+    mock_repo.repo.remote.return_value.url = '/repos/patches_repo'
+    (tmp_path / 'FETCH_HEAD').write_text(
+        f"1234abcd\t\tbranch 'master' of {fetched_url}\n")
+
+    assert fetch_if_stale(mock_repo, "my_remote") is True
+    mock_repo.remote.fetch.assert_called_once_with("my_remote")
 
 
-def test_rebase_and_update_remote_success_after_retry(mock_repo, monkeypatch):
+def test_rebase_and_update_remote_success_after_retry(mock_repo, rebaser):
     """
     GIVEN Rebaser initialized correctly
     WHEN rebase_and_update_remote is called
     AND the remote changes once during the rebase
     THEN the tag gets created
-    AND the previous tag gets deleted and re-created during the retry
+    AND the tag gets force-moved to the new remote HEAD during the retry
     AND git.push is called
     """
-    monkeypatch.setattr(time, 'sleep', lambda s: None)
 
-    rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
-                      "my_tstamp", dev_mode=True)
-
-    mock_repo.commit.same.side_effect = [False, True]
+    mock_repo.commit.same.side_effect = [False, False, True]
     rebaser.rebase_and_update_remote()
 
-    assert mock_repo.tag.create.call_count == 2
+    assert mock_repo.git.tag.call_count == 2
     assert mock_repo.remote.fetch.call_count == 4
-    mock_repo.tag.delete.assert_called_once()
+    mock_repo.git.commit_graph.assert_called_once()
+    mock_repo.git.tag.assert_called_with(
+        "-f", rebaser.tag_name, rebaser.remote_branch)
+    mock_repo.tag.delete.assert_not_called()
 
     mock_repo.git.push.assert_called()
 
 
-def test_rebase_and_update_remote_stop_after_retries(mock_repo, monkeypatch):
+# max_retries=0 means only ever try once
+@pytest.mark.parametrize("max_retries", [0, 1, 2])
+def test_rebase_and_update_remote_stop_after_retries(mock_repo, max_retries):
     """
     GIVEN Rebaser initialized correctly
     WHEN rebase_and_update_remote is called
     AND the remote keeps changing during the rebase
-    THEN the tag gets updated (recreated) during each attempt
-    AND git.push is not called in the end
+    THEN the tag gets force-moved during each retry
+    AND the remote patches branch is not updated in the end
     """
-    monkeypatch.setattr(time, 'sleep', lambda s: None)
-    monkeypatch.setattr(Rebaser, 'update_remote_patches_branch',
-                        lambda s: None)
-
     mock_repo.commit.same.return_value = False
 
-    def retry(max_retries):
-        rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
-                          "my_tstamp", True, max_retries)
+    rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
+                      "my_tstamp", True, max_retries)
+    with patch.object(Rebaser, 'update_remote_patches_branch',
+                      autospec=True) as mock_update:
         rebaser.rebase_and_update_remote()
 
-        assert mock_repo.tag.create.call_count == 1 + max_retries
-        assert mock_repo.remote.fetch.call_count == 2 + 2 * max_retries
-        assert mock_repo.tag.delete.call_count == max_retries
-        mock_repo.git.push.assert_not_called()
+    assert mock_repo.git.tag.call_count == 1 + max_retries
+    assert mock_repo.remote.fetch.call_count == 2 + 2 * max_retries
+    assert mock_repo.branch.rebase_to_hash.call_count == 1 + max_retries
+    mock_repo.git.push.assert_not_called()
+    mock_update.assert_not_called()
+
+
+def test_rebase_and_update_remote_keeps_retry_budget(mock_repo):
+    """
+    GIVEN Rebaser initialized correctly
+    WHEN rebase_and_update_remote is called twice
+    AND the remote keeps changing during the rebase
+    THEN both calls get the full number of retries
+    """
+    mock_repo.commit.same.return_value = False
+
+    rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
+                      "my_tstamp", True, 2)
+    rebaser.rebase_and_update_remote()
+    rebaser.rebase_and_update_remote()
+
+    assert rebaser.max_retries == 2
+    assert mock_repo.branch.rebase_to_hash.call_count == 6
+
+
+def test_rebase_and_update_remote_backs_off(mock_repo, monkeypatch):
+    """
+    GIVEN Rebaser initialized correctly
+    WHEN rebase_and_update_remote is called
+    AND the remote keeps changing during the rebase
+    THEN the delay between attempts grows exponentially, within jitter
+    AND the delay never goes over max_delay, within jitter
+    """
+    delays = []
+    monkeypatch.setattr(time, 'sleep', delays.append)
+    mock_repo.commit.same.return_value = False
+
+    rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
+                      "my_tstamp", True, 5, max_delay=10.0)
+    rebaser.rebase_and_update_remote()
+
+    assert len(delays) == 5
+    for expected, delay in zip([1, 2, 4, 8, 10], delays):
+        assert expected * 0.9 <= delay <= expected * 1.1
+
 
-        mock_repo.reset_mock()
+def test_rebase_and_update_remote_fetches_after_backoff(
+        mock_repo, rebaser, monkeypatch):
+    """
+    GIVEN Rebaser initialized correctly
+    WHEN rebase_and_update_remote is called
+    AND the remote changes once during the rebase
+    THEN the remote is fetched again after waiting, before the retry
+    """
+    calls = []
+    monkeypatch.setattr(time, 'sleep', lambda s: calls.append('sleep'))
+    mock_repo.remote.fetch.side_effect = lambda r: calls.append('fetch')
+    mock_repo.branch.create.side_effect = lambda *a, **kw: calls.append(
+        'reset')
+
+    mock_repo.commit.same.side_effect = [False, False, True]
+    rebaser.rebase_and_update_remote()
 
-    retry(0)  # Only ever try once
-    retry(1)
-    retry(2)
+    assert calls == ['fetch', 'reset', 'fetch', 'sleep', 'fetch', 'reset',
+                     'fetch']
 
 
-def test_rebase_and_update_remote_fails_next_rebase(mock_repo, monkeypatch):
+def test_rebase_and_update_remote_fails_next_rebase(mock_repo, rebaser):
     """
     GIVEN Rebaser initialized correctly
     WHEN rebase_and_update_remote is called
@@ -281,24 +613,101 @@ def test_rebase_and_update_remote_fails_next_rebase(mock_repo, monkeypatch):
     THEN a RebaseException is raised
     AND git.push is not called
     """
-    monkeypatch.setattr(time, 'sleep', lambda s: None)
 
-    mock_repo.branch.rebase_to_hash.side_effect = [None,
-                                                   exceptions.RebaseException]
-    mock_repo.commit.same.side_effect = [False, True]
+    mock_repo.branch.rebase_to_hash.side_effect = [None, RebaseException]
+    mock_repo.commit.same.side_effect = [False, False, True]
 
-    rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
-                      "my_tstamp", dev_mode=True)
-    with pytest.raises(exceptions.RebaseException):
+    with pytest.raises(RebaseException):
         rebaser.rebase_and_update_remote()
 
     assert mock_repo.remote.fetch.call_count == 3
 
-    assert mock_repo.tag.create.call_count == 2
-    mock_repo.tag.delete.assert_called_once()
+    assert mock_repo.git.tag.call_count == 2
     mock_repo.git.push.assert_not_called()
 
 
+def test_fetch_remote_full_by_default(mock_repo, rebaser):
+    """
+    GIVEN Rebaser initialized with the default options
+    WHEN fetch_remote is called
+    THEN remote.fetch is called
+    AND no partial fetch is attempted
+    """
+    rebaser.fetch_remote()
+
+    mock_repo.remote.fetch.assert_called_once_with("my_remote")
+    mock_repo.git.fetch.assert_not_called()
+
+
+@pytest.mark.parametrize("rebaser", [{"partial_fetch": True}], indirect=True)
+def test_fetch_remote_partial(mock_repo, rebaser):
+    """
+    GIVEN Rebaser initialized with partial_fetch enabled
+    WHEN fetch_remote is called
+    THEN git.fetch is called with a blob filter
+    AND remote.fetch is not called
+    """
+    rebaser.fetch_remote()
+
+    mock_repo.git.fetch.assert_called_once_with(
+        "my_remote", "--filter=blob:none", "--no-tags")
+    mock_repo.remote.fetch.assert_not_called()
+
+
+@pytest.mark.parametrize("rebaser", [{"partial_fetch": True}], indirect=True)
+def test_fetch_remote_falls_back_to_full_fetch(mock_repo, rebaser):
+    """
+    GIVEN Rebaser initialized with partial_fetch enabled
+    WHEN fetch_remote is called
+    AND the partial fetch fails
+    THEN remote.fetch is called instead
+    AND later fetches go straight to remote.fetch
+    """
+    mock_repo.git.fetch.side_effect = GitCommandError("fetch", 128)
+
+    rebaser.fetch_remote()
+    rebaser.fetch_remote()
+
+    mock_repo.git.fetch.assert_called_once()
+    assert mock_repo.remote.fetch.call_count == 2
+
+
+def test_enable_commit_graph_failure_is_not_fatal(mock_repo, rebaser):
+    """
+    GIVEN Rebaser initialized correctly
+    WHEN enable_commit_graph is called
+    AND git fails to write the commit-graph
+    THEN no exception is raised
+    """
+    mock_repo.git.commit_graph.side_effect = GitCommandError(
+        "commit-graph", 129)
+
+    rebaser.enable_commit_graph()
+
+    mock_repo.git.commit_graph.assert_called_once_with(
+        "write", "--reachable", "--changed-paths")
+
+
+@pytest.mark.parametrize("graph_file", [
+    "commit-graph", "commit-graphs/commit-graph-chain"])
+def test_enable_commit_graph_already_written(
+        mock_repo, rebaser, tmp_path, graph_file):
+    """
+    GIVEN a repo which already has a commit-graph
+    WHEN enable_commit_graph is called
+    THEN the git config is left alone
+    AND the commit-graph is not rewritten
+    """
+    graph_path = tmp_path / 'objects' / 'info' / graph_file
+    graph_path.parent.mkdir(parents=True)
+    graph_path.touch()
+
+    rebaser.enable_commit_graph()
+
+    mock_repo.git.config.assert_not_called()
+    mock_repo.git.commit_graph.assert_not_called()
+
+
 def test_get_rebaser_config_with_fallback_value(mock_config):
     """
     GIVEN a dictionary defining configuration defaults
@@ -325,7 +734,87 @@ def test_get_rebaser_config_defaults_dont_override_ini_values(mock_config):
     assert config.remote_name == "test_remote_name"
 
 
-def test_main_function(mock_env, mock_config, monkeypatch):
+def test_get_rebaser_config_packages_to_process(tmp_path, monkeypatch):
+    """
+    GIVEN a config with a comma-separated packages_to_process list
+    WHEN get_rebaser_config is called
+    THEN packages_to_process is a set of the package names
+    AND whitespace and empty entries are ignored
+    """
+    config_file = tmp_path / 'patch_rebaser.ini'
+    config_file.write_text("[DEFAULT]\npackages_to_process = pkgA, pkgB,,\n")
+    monkeypatch.setattr(patch_rebaser.patch_rebaser, 'CONFIG_FILE',
+                        str(config_file))
+    defaults = {'remote_name': 'remote', 'git_name': 'TEST',
+                'git_email': 'test@example.com', 'dlrn_projects_ini': '',
+                'dev_mode': 'true', 'create_patches_branch': 'false',
+                'partial_fetch': 'false', 'lock_dir': '',
+                'patches_repo_key': 'patches'}
+
+    config = get_rebaser_config(defaults)
+
+    assert config.packages_to_process == frozenset(['pkgA', 'pkgB'])
+
+
+def test_get_rebaser_config_missing_option(mock_config):
+    """
+    GIVEN a dictionary defining configuration defaults
+    WHEN get_rebaser_config is called
+    AND an option exists neither in the config nor in the defaults
+    THEN a NoOptionError exception is raised
+    """
+    with pytest.raises(configparser.NoOptionError):
+        get_rebaser_config({'remote_name': 'Wrong_name'})
+
+
+def test_get_rebaser_configparser_is_cached(mock_config):
+    """
+    GIVEN a valid patch_rebaser configuration
+    WHEN get_rebaser_configparser is called twice with the same defaults
+    THEN the same parsed config is returned
+    AND calling it with different defaults returns a different config
+    """
+    defaults = {'git_name': 'TEST'}
+    parser = get_rebaser_configparser(defaults)
+
+    assert get_rebaser_configparser(dict(defaults)) is parser
+    assert get_rebaser_configparser({'git_name': 'OTHER'}) is not parser
+
+
+def test_get_downstream_distgit_branch_is_cached(tmp_path):
+    """
+    GIVEN a DLRN projects.ini file
+    WHEN get_downstream_distgit_branch is called
+    THEN the downstream distgit branch is returned
+    AND the new value is returned once the file is modified
+    """
+    projects_ini = tmp_path / 'projects.ini'
+    projects_ini.write_text(
+        "[downstream_driver]\ndownstream_distro_branch = rhos-16.1\n")
+    assert get_downstream_distgit_branch(str(projects_ini)) == 'rhos-16.1'
+
+    projects_ini.write_text(
+        "[downstream_driver]\ndownstream_distro_branch = rhos-17.10\n")
+    assert get_downstream_distgit_branch(str(projects_ini)) == 'rhos-17.10'
+
+
+def test_get_dlrn_projects_parses_once(tmp_path):
+    """
+    GIVEN a DLRN projects.ini file
+    WHEN get_dlrn_projects is called twice
+    THEN the same parsed configuration is returned both times
+    """
+    projects_ini = tmp_path / 'projects.ini'
+    projects_ini.write_text(
+        "[downstream_driver]\ndownstream_distro_branch = rhos-16.1\n")
+
+    config = get_dlrn_projects(str(projects_ini))
+    assert config is get_dlrn_projects(str(projects_ini))
+    assert config.get('downstream_driver',
+                      'downstream_distro_branch') == 'rhos-16.1'
+
+
+def test_main_function(mock_env, mock_config, monkeypatch, tmp_path):
     """
     GIVEN a valid patch_rebaser configuration and environment
     WHEN main() is called
@@ -335,27 +824,69 @@ def test_main_function(mock_env, mock_config, monkeypatch):
     """
     branch_name = 'test-16.1-patches'
     commit_to_rebase_to = '123456a'
-    repo = MagicMock()
+    repo = MagicMock(spec=GitRepo)
+    repo.repo.git_dir = str(tmp_path)
+    repo.repo.working_dir = str(tmp_path)
+    repo.commit.same.side_effect = [False, True]
 
+    pr = patch_rebaser.patch_rebaser
+    # Only calls on repo are checked, plain stubs are enough for the rest
     with monkeypatch.context() as m:
-        m.setattr(patch_rebaser.patch_rebaser, 'GitRepo',
-                  Mock(return_value=repo))
-        m.setattr(patch_rebaser.patch_rebaser, 'get_patches_repo', Mock())
-        m.setattr(patch_rebaser.patch_rebaser, 'get_patches_branch',
-                  Mock(return_value=branch_name))
+        m.setattr(git_wrapper.repo, 'GitRepo', lambda path: repo)
+        m.setattr(pr, 'get_patches_repo',
+                  lambda *args: 'ssh://example.com/test_package')
+        m.setattr(pr, 'get_patches_branch', lambda *args: branch_name)
         main()
 
     repo.branch.rebase_to_hash.assert_called_once_with(
         branch_name, commit_to_rebase_to)
     repo.git.push.assert_called()
+    repo.remote.fetch.assert_called_with('test_remote_name')
+    repo.git.fetch.assert_not_called()
 
     # Check version in tag
-    assert repo.git.push.mock_calls[0].args[2].startswith(
-        'private-rebaser-16.1-') is True
+    assert repo.git.push.mock_calls[0].args[4].startswith(
+        'refs/tags/private-rebaser-16.1-') is True
+
+
+def test_main_fetches_all_remotes(mock_env, mock_config, monkeypatch,
+                                  tmp_path):
+    """
+    GIVEN a valid patch_rebaser configuration and environment
+    WHEN main() is called
+    AND fetching one of the remotes fails
+    THEN the other remotes are still fetched, the patches remote last
+    AND a RemoteException listing the failed remote is raised
+    """
+    def mock_fetch(remote):
+        if remote == 'a_remote':
+            raise RemoteException("Could not fetch remote a_remote")
+
+    repo = MagicMock(spec=GitRepo)
+    repo.repo.git_dir = str(tmp_path)
+    repo.remote.names.return_value = ['a_remote', 'test_remote_name',
+                                      'z_remote']
+    repo.remote.fetch.side_effect = mock_fetch
+
+    pr = patch_rebaser.patch_rebaser
+    mock_get_branch = Mock()
+    with monkeypatch.context() as m:
+        m.setattr(git_wrapper.repo, 'GitRepo', lambda path: repo)
+        m.setattr(pr, 'get_patches_repo',
+                  lambda *args: 'ssh://example.com/test_package')
+        m.setattr(pr, 'get_patches_branch', mock_get_branch)
+        with pytest.raises(RemoteException, match='a_remote'):
+            main()
 
+    assert [c.args[0] for c in repo.remote.fetch.mock_calls] == [
+        'a_remote', 'z_remote', 'test_remote_name']
+    mock_get_branch.assert_not_called()
 
+
+@pytest.mark.parametrize("mock_config", ["pkgs_to_process_config.ini"],
+                         indirect=True)
 def test_packages_to_process_skips_packages_not_in_the_list(
-        mock_env, mock_config_with_pkgs_to_process, monkeypatch):
+        mock_env, mock_config, monkeypatch):
     """
     GIVEN a valid patch_rebaser configuration and environment
     WITH packages_to_process set to a list of package names
@@ -366,23 +897,21 @@ def test_packages_to_process_skips_packages_not_in_the_list(
     mock_gitrepo = Mock()
 
     with monkeypatch.context() as m:
-        m.setattr(patch_rebaser.patch_rebaser, 'GitRepo', mock_gitrepo)
+        m.setattr(git_wrapper.repo, 'GitRepo', mock_gitrepo)
         main()
 
     mock_gitrepo.assert_not_called()
 
 
-def test_rebase_exception_gitreview(mock_repo):
+def test_rebase_exception_gitreview(mock_repo, rebaser):
     """
     GIVEN Rebaser initialized correctly
     WHEN perform_rebase asserts with RebaseException
     THEN Rebaser calls the try_automated_rebase_fix method
     """
     mock_repo.branch.rebase_to_hash.side_effect = [
-        exceptions.RebaseException('.gitreview failed to rebase'),
+        RebaseException('.gitreview failed to rebase'),
         True]
-    rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
-                      "my_tstamp", dev_mode=True)
 
     rebaser.try_automated_rebase_fix = Mock()
     rebaser.try_automated_rebase_fix.side_effect = [True]
@@ -390,8 +919,7 @@ def test_rebase_exception_gitreview(mock_repo):
     rebaser.try_automated_rebase_fix.assert_called()
 
 
-@mock.patch('patch_rebaser.patch_rebaser._rebuild_gitreview')
-def test_try_automated_rebase_fix(reb_mock, mock_repo):
+def test_try_automated_rebase_fix(mock_repo, mock_rebuild_gitreview, rebaser):
     """
     GIVEN Rebaser initialized correctly
     WHEN perform_rebase asserts with RebaseException
@@ -400,19 +928,39 @@ def test_try_automated_rebase_fix(reb_mock, mock_repo):
     THEN try_automated_rebase_fix detects .gitreview in the exception message
     AND calls git.rebase('--skip') and _rebuild_gitreview
     """
-
-    rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
-                      "my_tstamp", dev_mode=True)
-
-    exception = exceptions.RebaseException('.gitreview failed to rebase')
+    exception = RebaseException('.gitreview failed to rebase')
     output = rebaser.try_automated_rebase_fix(exception)
 
     mock_repo.git.rebase.assert_called_with('--skip')
-    reb_mock.assert_called()
+    mock_rebuild_gitreview.assert_called()
     assert output is True
 
 
-def test_rebase_exception_not_gitreview(mock_repo):
+def test_try_automated_rebase_fix_reuses_gitreview_context(
+        mock_repo, mock_env, monkeypatch, rebaser):
+    """
+    GIVEN Rebaser initialized correctly
+    WHEN try_automated_rebase_fix fixes several .gitreview failures
+    THEN the remote url is only looked up once
+    AND the .gitreview file is written for each failure
+    """
+    mock_generate = Mock()
+    monkeypatch.setattr(patch_rebaser.patch_rebaser, 'generate_gitreview',
+                        mock_generate)
+    mock_repo.repo.remote.return_value.url = 'ssh://code.example.com:22/kolla'
+
+    exception = RebaseException('.gitreview failed to rebase')
+    assert rebaser.try_automated_rebase_fix(exception) is True
+    assert rebaser.try_automated_rebase_fix(exception) is True
+
+    mock_repo.repo.remote.assert_called_once_with("my_remote")
+    assert mock_generate.call_count == 2
+    mock_generate.assert_called_with(mock_repo.repo.working_dir, 'kolla',
+                                     'code.example.com', '22', 'my_branch',
+                                     'my_remote')
+
+
+def test_rebase_exception_not_gitreview(mock_repo, rebaser):
     """
     GIVEN Rebaser initialized correctly
     WHEN perform_rebase asserts with RebaseException
@@ -420,13 +968,11 @@ def test_rebase_exception_not_gitreview(mock_repo):
     THEN Rebaser calls the repo.branch.abort_rebase method
     """
     mock_repo.branch.rebase_to_hash.side_effect = [
-        exceptions.RebaseException('Whatever other exception'),
+        RebaseException('Whatever other exception'),
         True]
-    rebaser = Rebaser(mock_repo, "my_branch", "my_commit", "my_remote",
-                      "my_tstamp", dev_mode=True)
 
     rebaser.repo.branch.abort_rebase = Mock()
-    with pytest.raises(exceptions.RebaseException):
+    with pytest.raises(RebaseException):
         rebaser.perform_rebase()
     rebaser.repo.branch.abort_rebase.assert_called()
 
@@ -460,8 +1006,41 @@ def test_parse_gerrit_remote_url_https_noport():
     assert project == 'base/name'
 
 
+def test_parse_gerrit_remote_url_ipv6():
+    """
+    GIVEN a url containing an IPv6 host, port and project
+    WHEN calling parse_gerrit_remote_url with the url
+    THEN We get the expected values for host, port and project
+    """
+    host, port, project = parse_gerrit_remote_url('ssh://[fd00::1]:22/kolla')
+
+    assert host == '[fd00::1]'
+    assert port == '22'
+    assert project == 'kolla'
+
+
+def test_generate_gitreview(tmp_path):
+    """
+    GIVEN a directory, project and Gerrit remote details
+    WHEN calling generate_gitreview
+    THEN a .gitreview file with those details is written in the directory
+    """
+    generate_gitreview(str(tmp_path), 'base/name', 'code.example.com', '22',
+                       'my_branch', 'my_remote')
+
+    assert (tmp_path / '.gitreview').read_text() == (
+        "[gerrit]\n"
+        "host=code.example.com\n"
+        "port=22\n"
+        "project=base/name.git\n"
+        "defaultbranch=my_branch\n"
+        "defaultremote=my_remote\n"
+        "defaultrebase=1\n"
+    )
+
+
 def test_rebaser_missing_patches_branch_no_create(mock_env, mock_config,
-                                                  monkeypatch):
+                                                  monkeypatch, tmp_path):
     """
     GIVEN a valid patch_rebaser configuration and environment
     WHEN main() is called
@@ -469,22 +1048,26 @@ def test_rebaser_missing_patches_branch_no_create(mock_env, mock_config,
     AND create_patches_branch is set to false
     THEN create_patches_branch is not called
     """
-    repo = MagicMock()
+    repo = MagicMock(spec=GitRepo)
+    repo.repo.git_dir = str(tmp_path)
 
+    pr = patch_rebaser.patch_rebaser
     with monkeypatch.context() as m:
-        m.setattr(patch_rebaser.patch_rebaser, 'GitRepo',
+        m.setattr(git_wrapper.repo, 'GitRepo',
                   Mock(return_value=repo))
-        m.setattr(patch_rebaser.patch_rebaser, 'get_patches_repo', Mock())
-        m.setattr(patch_rebaser.patch_rebaser, 'get_patches_branch',
-                  Mock(return_value=None))
-        patch_rebaser.patch_rebaser.create_patches_branch = MagicMock()
+        m.setattr(pr, 'get_patches_repo', Mock())
+        m.setattr(pr, 'get_patches_branch', Mock(return_value=None))
+        mock_create = Mock()
+        m.setattr(pr, 'create_patches_branch', mock_create)
         main()
 
-    assert patch_rebaser.patch_rebaser.create_patches_branch.called is False
+    assert mock_create.called is False
 
 
+@pytest.mark.parametrize("mock_config", ["test_config_create_branch.ini"],
+                         indirect=True)
 def test_rebaser_missing_patches_branch_create(
-        mock_env, mock_config_with_create_patches_branch, monkeypatch):
+        mock_env, mock_config, monkeypatch, tmp_path):
     """
     GIVEN a valid patch_rebaser configuration and environment
     WHEN main() is called
@@ -492,21 +1075,24 @@ def test_rebaser_missing_patches_branch_create(
     AND create_patches_branch is set to true
     THEN create_patches_branch is called
     """
-    repo = MagicMock()
+    repo = MagicMock(spec=GitRepo)
+    repo.repo.git_dir = str(tmp_path)
 
+    pr = patch_rebaser.patch_rebaser
     with monkeypatch.context() as m:
-        m.setattr(patch_rebaser.patch_rebaser, 'GitRepo',
+        m.setattr(git_wrapper.repo, 'GitRepo',
                   Mock(return_value=repo))
-        m.setattr(patch_rebaser.patch_rebaser, 'get_patches_repo', Mock())
-        m.setattr(patch_rebaser.patch_rebaser, 'get_patches_branch',
-                  Mock(return_value=None))
-        patch_rebaser.patch_rebaser.create_patches_branch = MagicMock()
+        m.setattr(pr, 'get_patches_repo', Mock())
+        m.setattr(pr, 'get_patches_branch', Mock(return_value=None))
+        mock_create = Mock()
+        m.setattr(pr, 'create_patches_branch', mock_create)
         main()
 
-    assert patch_rebaser.patch_rebaser.create_patches_branch.called is True
+    assert mock_create.called is True
 
 
-def test_create_branch_with_dev_mode(mock_repo, mock_env, monkeypatch):
+def test_create_branch_with_dev_mode(mock_repo, mock_env,
+                                     mock_rebuild_gitreview):
     """
     GIVEN a valid patch_rebaser configuration and environment
     WHEN create_patches_branch() is called
@@ -514,18 +1100,18 @@ def test_create_branch_with_dev_mode(mock_repo, mock_env, monkeypatch):
     THEN _rebuild_gitreview is called
     AND git.push is called with -nf as parameter
     """
+    create_patches_branch(mock_repo, '123456a', 'my_remote',
+                          branch_name='test-patches')
 
-    patch_rebaser.patch_rebaser._rebuild_gitreview = MagicMock()
-    create_patches_branch(mock_repo, '123456a', 'my_remote')
-
-    assert patch_rebaser.patch_rebaser._rebuild_gitreview.called is True
+    assert mock_rebuild_gitreview.called is True
     assert mock_repo.git.push.called is True
 
-    expected = [(("-n", "my_remote", "test-patches"),)]
-    assert mock_repo.git.push.call_args_list == expected
+    mock_repo.git.push.assert_called_once_with(
+        "-n", "my_remote", "test-patches")
 
 
-def test_create_branch_without_dev_mode(mock_repo, mock_env, monkeypatch):
+def test_create_branch_without_dev_mode(mock_repo, mock_env,
+                                        mock_rebuild_gitreview):
     """
     GIVEN a valid patch_rebaser configuration and environment
     WHEN create_patches_branch() is called
@@ -533,27 +1119,37 @@ def test_create_branch_without_dev_mode(mock_repo, mock_env, monkeypatch):
     THEN _rebuild_gitreview is called
     AND git.push is called with -f as parameter
     """
+    create_patches_branch(mock_repo, '123456a', 'my_remote', dev_mode=False,
+                          branch_name='test-patches')
 
-    patch_rebaser.patch_rebaser._rebuild_gitreview = MagicMock()
-    create_patches_branch(mock_repo, '123456a', 'my_remote', dev_mode=False)
-
-    assert patch_rebaser.patch_rebaser._rebuild_gitreview.called is True
+    assert mock_rebuild_gitreview.called is True
     assert mock_repo.git.push.called is True
 
-    expected = [(("my_remote", "test-patches"),)]
-    assert mock_repo.git.push.call_args_list == expected
+    mock_repo.git.push.assert_called_once_with("my_remote", "test-patches")
+
 
+@pytest.mark.parametrize("branch,release", [
+    ("rhos-16.1-trunk-patches", "16.1"),
+    ("rhos-90-trunk-patches", "90"),
+    ("rhos-10.0-patches", "10.0"),
+    ("my_branch", "Unknown"),
+    ("rhos-18.0-foo-trunk-patches", "18.0-foo"),
+    ("rhos-13.0-octavia-patches", "13.0-octavia"),
+    ("rhos-10.0", "Unknown"),
+])
+def test_get_release_from_branch_name(branch, release):
+    assert get_release_from_branch_name(branch) == release
 
-def test_get_release_from_branch_name():
-    branches = {
-        "rhos-16.1-trunk-patches": "16.1",
-        "rhos-90-trunk-patches": "90",
-        "rhos-10.0-patches": "10.0",
-        "my_branch": "Unknown",
-        "rhos-18.0-foo-trunk-patches": "18.0-foo",
-        "rhos-13.0-octavia-patches": "13.0-octavia",
-        "rhos-10.0": "Unknown"
-    }
 
-    for branch, release in branches.items():
-        assert get_release_from_branch_name(branch) == release
+def test_create_branch_without_branch_name(mock_repo,
+                                           mock_rebuild_gitreview):
+    """
+    GIVEN a package without a PATCHES_BRANCH
+    WHEN create_patches_branch() is called
+    THEN no branch is created
+    AND None is returned
+    """
+    assert create_patches_branch(mock_repo, '123456a', 'my_remote') is None
+
+    mock_repo.branch.create.assert_not_called()
+    mock_repo.git.push.assert_not_called()